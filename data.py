@@ -2,8 +2,8 @@ from __future__ import absolute_import
 import matplotlib.pyplot as plt
 import matplotlib.image
 
-import autograd.numpy as np
-import autograd.numpy.random as npr
+import numpy as np
+import numpy.random as npr
 import data_mnist
 
 def load_mnist():
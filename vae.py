@@ -1,13 +1,15 @@
 # Implements auto-encoding variational Bayes.
 
-import autograd.numpy as np
-import autograd.numpy.random as npr
-import autograd.scipy.stats.norm as norm
-    
-from autograd import grad
+import numpy as np
+import numpy.random as npr
+import jax
+import jax.numpy as jnp
+
+from functools import partial
+from numba import njit
+from jax.tree_util import tree_map, tree_structure, tree_transpose # Used to apply the ADAM updates to every array of the params pytree
 from data import load_mnist
 from data import save_images as s_images
-from autograd.misc import flatten # This is used to flatten the params (transforms a list into a numpy array)
 
 # images is an array with one row per image, file_name is the png file on which to save the images
 
@@ -16,11 +18,11 @@ def save_images(images, file_name): return s_images(images, file_name, vmin = 0.
 # Sigmoid activiation function to estimate probabilities
 
 def sigmoid(x):
-    return 1.0 / (1.0 + np.exp(-x))
+    return 1.0 / (1.0 + jnp.exp(-x))
 
 # Relu activation function for non-linearity
 
-def relu(x):    return np.maximum(0, x)
+def relu(x):    return jnp.maximum(0, x)
 
 # This function intializes the parameters of a deep neural network
 
@@ -28,8 +30,8 @@ def init_net_params(layer_sizes, scale = 1e-2):
 
     """Build a (weights, biases) tuples for all layers."""
 
-    return [(scale * npr.randn(m, n),   # weight matrix
-             scale * npr.randn(n))      # bias vector
+    return [((scale * npr.randn(m, n)).astype(np.float32),   # weight matrix
+             (scale * npr.randn(n)).astype(np.float32))      # bias vector
             for m, n in zip(layer_sizes[:-1], layer_sizes[1:])]
 
 # This will be used to normalize the activations of the NN
@@ -43,33 +45,92 @@ def neural_net_predict(params, inputs):
        Applies batch normalization to every layer but the last."""
 
     for W, b in params[:-1]:
-        outputs = np.dot(inputs, W) + b  # linear transformation
+        outputs = jnp.dot(inputs, W) + b  # linear transformation
         inputs = relu(outputs)         # nonlinear transformation
 
     # Last layer is linear
 
     outW, outb = params[-1]
-    outputs = np.dot(inputs, outW) + outb
+    outputs = jnp.dot(inputs, outW) + outb
 
     return outputs
 
+# Forward-only version of neural_net_predict compiled with numba, used to generate images once training is done.
+# It is not differentiable, so training keeps using neural_net_predict.
+
+def fast_net_params(params):
+
+    """Converts a list of (weights, bias) tuples into a (weights, biases) pair of tuples
+       of contiguous float32 arrays, as expected by neural_net_predict_fast."""
+
+    Ws = tuple(np.ascontiguousarray(W, dtype=np.float32) for W, b in params)
+    bs = tuple(np.ascontiguousarray(b, dtype=np.float32) for W, b in params)
+
+    return Ws, bs
+
+def fast_net_buffers(params, max_batch):
+
+    """Preallocates one (max_batch x layer output size) float32 buffer per layer
+       for neural_net_predict_fast, params being built with fast_net_params."""
+
+    Ws, bs = params
+
+    return tuple(np.empty((max_batch, W.shape[1]), dtype=np.float32) for W in Ws)
+
+@njit(cache=True, fastmath=True)
+def neural_net_predict_fast(params, inputs, buffers):
+
+    """Params is a pair of tuples (weights, biases) built with fast_net_params.
+       inputs is an (N x D) contiguous float32 matrix, with N at most the max_batch of the buffers.
+       The output is a view of the last buffer, so it is overwritten by the next call using the same buffers."""
+
+    Ws, bs = params
+    n = inputs.shape[0]
+
+    for i in range(len(Ws)):
+        outputs = buffers[i][:n]
+        np.dot(inputs, Ws[i], outputs)         # linear transformation
+        np.add(outputs, bs[i], outputs)
+
+        # Last layer is linear
+
+        if i < len(Ws) - 1:
+            np.maximum(outputs, 0.0, outputs)  # in-place relu
+
+        inputs = outputs
+
+    return inputs
+
 # This implements the reparametrization trick
 
-def sample_latent_variables_from_posterior(encoder_output):
+def sample_latent_variables_from_posterior(encoder_output, key):
 
     # Params of a diagonal Gaussian.
 
-    D = np.shape(encoder_output)[-1] // 2
-    mean, log_std = encoder_output[:, :D], encoder_output[:, D:]
+    D = jnp.shape(encoder_output)[-1] // 2
+    mean, log_std = encoder_output[..., :D], encoder_output[..., D:]
 
     # Reparametrization trick to generate one sample from q(z|x) per each batch datapoint
-    z_i = mean + np.exp(log_std) * npr.randn(*mean.shape) # Equation 15
+    z_i = mean + jnp.exp(log_std) * jax.random.normal(key, mean.shape) # Equation 15
 
     # The output of this function is a matrix of size the batch x the number of latent dimensions
     return z_i
 
+# Sampling only version of sample_latent_variables_from_posterior compiled with numba, used to generate images
+# once training is done. eps holds the standard normal samples, and numba fuses the whole expression into a single
+# loop without temporaries. It is not differentiable, so training keeps using sample_latent_variables_from_posterior.
+
+@njit(cache=True, fastmath=True)
+def sample_latent_variables_from_posterior_fast(encoder_output, eps):
+
+    D = encoder_output.shape[-1] // 2
+    mean, log_std = encoder_output[:, :D], encoder_output[:, D:]
+
+    return mean + np.exp(log_std) * eps
+
 # This evlauates the log of the term that depends on the data
 
+@jax.custom_vjp
 def bernoulli_log_prob(targets, logits):
 
     # logits are in R
@@ -79,28 +140,57 @@ def bernoulli_log_prob(targets, logits):
     # sum the probabilities across the dimensions of each image in the batch. The output of this function 
     # should be a vector of size the batch size
 
-    sig_logits = sigmoid(logits)
+    # This is log(sigmoid(logits)) for the targets and log(1 - sigmoid(logits)) for the rest, written with the
+    # binary cross entropy with logits identity so that it is computed in a single numerically stable pass
+
+    return -jnp.sum(jnp.maximum(logits, 0) - logits * targets + jnp.log1p(jnp.exp(-jnp.abs(logits))), axis=-1)
+
+# The log probability is targets * logits - softplus(logits), so its gradient w.r.t. the logits is just
+# targets - sigmoid(logits). The backward pass is written directly instead of differentiating the expression above
 
-    return np.sum(np.log(targets * sig_logits + (1 - targets) * (1 - sig_logits)), axis=1)
+def bernoulli_log_prob_fwd(targets, logits):
+    return bernoulli_log_prob(targets, logits), (targets, logits)
+
+def bernoulli_log_prob_bwd(residuals, g):
+    targets, logits = residuals
+    g = g[..., None]
+    return g * logits, g * (targets - sigmoid(logits))
+
+bernoulli_log_prob.defvjp(bernoulli_log_prob_fwd, bernoulli_log_prob_bwd)
 
 # This evaluates the KL between q and the prior
 
+@jax.custom_vjp
 def compute_KL(q_means_and_log_stds):
     
-    D = np.shape(q_means_and_log_stds)[-1] // 2
-    mean, log_std = q_means_and_log_stds[:, :D], q_means_and_log_stds[:, D:]
+    D = jnp.shape(q_means_and_log_stds)[-1] // 2
+    mean, log_std = q_means_and_log_stds[..., :D], q_means_and_log_stds[..., D:]
 
     # Compute the KL divergence between q(z|x) and the prior (use a standard Gaussian for the prior)
     # Use the fact that the KL divervence is the sum of KL divergence of the marginals if q and p factorize
     # The output of this function should be a vector of size the batch size
 
-    variance = np.exp(log_std * 2)
+    variance = jnp.exp(log_std * 2)
+
+    return .5 * jnp.sum((variance + mean**2 - 1 - 2 * log_std), axis=-1)
+
+# The gradient of the KL is the mean w.r.t. the means and variance - 1 w.r.t. the log stds, so the backward
+# pass is written directly instead of differentiating the expression above
+
+def compute_KL_fwd(q_means_and_log_stds):
+    return compute_KL(q_means_and_log_stds), q_means_and_log_stds
 
-    return .5 * np.sum((variance + mean**2 - 1 - 2 * log_std), axis=1)
+def compute_KL_bwd(q_means_and_log_stds, g):
+    D = jnp.shape(q_means_and_log_stds)[-1] // 2
+    mean, log_std = q_means_and_log_stds[..., :D], q_means_and_log_stds[..., D:]
+    g = g[..., None]
+    return (jnp.concatenate([g * mean, g * (jnp.exp(log_std * 2) - 1)], axis=-1),)
+
+compute_KL.defvjp(compute_KL_fwd, compute_KL_bwd)
 
 # This evaluates the lower bound
 
-def vae_lower_bound(gen_params, rec_params, data):
+def vae_lower_bound(gen_params, rec_params, data, key):
     # Compute a noisy estiamte of the lower bound by using a single Monte Carlo sample:
     
     # 1 - compute the encoder output using neural_net_predict given the data and rec_params
@@ -108,7 +198,7 @@ def vae_lower_bound(gen_params, rec_params, data):
     
     # 2 - sample the latent variables associated to the batch in data 
     #     (use sample_latent_variables_from_posterior and the encoder output)
-    sampled_latent_variables = sample_latent_variables_from_posterior(encoder_output)
+    sampled_latent_variables = sample_latent_variables_from_posterior(encoder_output, key)
 
     # 3 - use the sampled latent variables to reconstruct the image and to compute the log_prob of the actual data
     #     (use neural_net_predict for that)
@@ -120,10 +210,20 @@ def vae_lower_bound(gen_params, rec_params, data):
     divergence = compute_KL(encoder_output)
 
     # 5 - return an average estimate (per batch point) of the lower bound by substracting the KL to the data dependent term
-    lower_bound_estimate = np.mean(log_prob - divergence)
+    lower_bound_estimate = jnp.mean(log_prob - divergence)
 
     return lower_bound_estimate
 
+# This evaluates the lower bound as the mean of the per datapoint lower bounds. vae_lower_bound is applied
+# to a single datapoint (and its own random key) and vectorized over the batch with jax.vmap
+
+def batched_vae_lower_bound(gen_params, rec_params, data, key):
+
+    keys = jax.random.split(key, data.shape[0])
+    per_example_lower_bound = jax.vmap(vae_lower_bound, in_axes = (None, None, 0, 0))
+
+    return jnp.mean(per_example_lower_bound(gen_params, rec_params, data, keys))
+
 
 if __name__ == '__main__':
 
@@ -149,6 +249,11 @@ if __name__ == '__main__':
 
     N, train_images, _, test_images, _ = load_mnist()
 
+    # Everything runs in float32, so the images are converted once after loading
+
+    train_images = np.ascontiguousarray(train_images, dtype=np.float32)
+    test_images = np.ascontiguousarray(test_images, dtype=np.float32)
+
     # Parameters for the generator network p(x|z)
 
     init_gen_params = init_net_params(gen_layer_sizes)
@@ -159,32 +264,25 @@ if __name__ == '__main__':
 
     combined_params_init = (init_gen_params, init_rec_params)
 
-    num_batches = int(np.ceil(len(train_images) / batch_size))
+    # lax.scan needs equally sized batches, so a trailing partial batch (if any) is dropped
 
-    # We flatten the parameters (transform the lists or tupples into numpy arrays)
+    num_batches = N // batch_size
 
-    flattened_combined_params_init, unflat_params = flatten(combined_params_init)
+    # Actual objective to optimize that receives the params pytree
 
-    # Actual objective to optimize that receives flattened params
+    def objective(combined_params, data, noise, key):
 
-    def objective(flattened_combined_params):
-
-        combined_params = unflat_params(flattened_combined_params)
-        data_idx = batch
         gen_params, rec_params = combined_params
 
-        # We binarize the data
+        # We binarize the data (noise holds the uniform samples drawn for this batch)
 
-        on = train_images[ data_idx ,: ] > npr.uniform(size = train_images[ data_idx ,: ].shape)
-        images = train_images[ data_idx, : ] * 0.0
-        images[ on ] = 1.0
+        images = (data > noise).astype(data.dtype)
 
-        return vae_lower_bound(gen_params, rec_params, images) 
+        return batched_vae_lower_bound(gen_params, rec_params, images, key)
 
-    # Get gradients of objective using autograd.
+    # Get the value and the gradients of objective using jax, so that the ELBO estimate reuses the forward pass
 
-    objective_grad = grad(objective)
-    flattened_current_params = flattened_combined_params_init
+    objective_value_and_grad = jax.value_and_grad(objective)
 
     # ADAM parameters
 
@@ -194,62 +292,118 @@ if __name__ == '__main__':
     beta2 =  0.999  # [0, 1)
     epsilon = 1e-8
 
-    m = np.zeros_like(flattened_current_params)
-    v = np.zeros_like(flattened_current_params)
+    # ADAM update of a single parameter array. The bias corrections of m and v are folded into the step size
+    # (alpha * sqrt(1 - beta2**t) / (1 - beta1**t)), which is equivalent to using m_est and v_est but lets m, v
+    # and the parameters be updated in a single elementwise pass
 
-    t = 1
+    def adam_update(p, m, v, g, t):
 
-    # We do the actual training
+        m = beta1 * m + (1 - beta1) * g
+        v = beta2 * v + (1 - beta2) * g**2
 
-    for epoch in range(num_epochs):
+        bias_correction2 = jnp.sqrt(1 - beta2**t)
+        step_size = alpha * bias_correction2 / (1 - beta1**t)
+
+        return p + step_size * m / (jnp.sqrt(v) + epsilon * bias_correction2), m, v
+
+    # One ADAM step compiled together with the gradient of the objective
+
+    @jax.jit
+    def step(combined_params, m, v, t, data, noise, key):
+
+        elbo, grad = objective_value_and_grad(combined_params, data, noise, key)
+
+        # Use the estimated noisy gradient in grad to update the paramters using the ADAM updates
+
+        updates = tree_map(lambda p, m, v, g: adam_update(p, m, v, g, t), combined_params, m, v, grad)
+        combined_params, m, v = tree_transpose(tree_structure(combined_params), tree_structure((0, 0, 0)), updates)
+
+        return combined_params, m, v, elbo
+
+    # A whole epoch is a single compiled graph: lax.scan runs the ADAM steps over the batches of a shuffled copy
+    # of the training images, so every step reads a contiguous block instead of gathering its rows.
+    # The params, m and v buffers are donated so that every epoch updates them in place.
+
+    @partial(jax.jit, donate_argnums = (0, 1, 2))
+    def run_epoch(combined_params, m, v, t, train_images, key):
+
+        perm_key, noise_key, key = jax.random.split(key, 3)
+        perm = jax.random.permutation(perm_key, N)[:num_batches * batch_size]
+        batches = train_images[ perm, : ].reshape(num_batches, batch_size, data_dim)
+
+        # The uniform samples used to binarize the whole epoch are drawn at once
+
+        epoch_noise = jax.random.uniform(noise_key, (num_batches, batch_size, data_dim), dtype=train_images.dtype)
 
-        elbo_est = 0.0
+        def body(carry, batch_and_noise):
+            combined_params, m, v, t, key = carry
+            batch, noise = batch_and_noise
+            key, step_key = jax.random.split(key)
+            combined_params, m, v, elbo = step(combined_params, m, v, t, batch, noise, step_key)
+            return (combined_params, m, v, t + 1, key), elbo
 
-        for n_batch in range(int(np.ceil(N / batch_size))):
+        (combined_params, m, v, t, _), elbos = jax.lax.scan(body, (combined_params, m, v, t, key), (batches, epoch_noise))
 
-            batch = np.arange(batch_size * n_batch, np.minimum(N, batch_size * (n_batch + 1)))
-            grad = objective_grad(flattened_current_params)
+        return combined_params, m, v, t, jnp.mean(elbos)
 
-            # Use the estimated noisy gradient in grad to update the paramters using the ADAM updates
+    # The training data and the initial parameters are moved to the device once
 
-            m = beta1 * m + (1 - beta1) * grad
-            
-            v = beta2 * v + (1 - beta2) * grad**2
+    train_images = jax.device_put(train_images)
 
-            m_est = m / (1 - beta1**t)
-            v_est = v / (1 - beta2**t)
+    current_params = jax.device_put(combined_params_init)
 
-            flattened_current_params += alpha * m_est / (np.sqrt(v_est) + epsilon)
-            
-            elbo_est += objective(flattened_current_params)
+    m = tree_map(jnp.zeros_like, current_params)
+    v = tree_map(jnp.zeros_like, current_params)
 
-            t += 1
+    t = jnp.asarray(1)
 
-        print("Epoch: %d ELBO: %e" % (epoch, elbo_est / np.ceil(N / batch_size)))
+    key = jax.random.PRNGKey(0)
+
+    # We do the actual training
+
+    for epoch in range(num_epochs):
+
+        key, epoch_key = jax.random.split(key)
+        current_params, m, v, t, elbo_est = run_epoch(current_params, m, v, t, train_images, epoch_key)
+
+        print("Epoch: %d ELBO: %e" % (epoch, elbo_est))
 
     # We obtain the final trained parameters
 
-    gen_params, rec_params = unflat_params(flattened_current_params)
+    gen_params, rec_params = current_params
 
-    # Subtask 3.1: Generate 25 images from prior (use neural_net_predict) and save them using save_images
     num_images = 25
+    num_reconstructions = 10
+    num_interpolations = 5
+    num_steps = 25
+
+    gen_params_fast = fast_net_params(gen_params)
+    rec_params_fast = fast_net_params(rec_params)
+
+    # The output buffers of every layer are allocated once, sized for the largest batch given to each network
+
+    gen_buffers = fast_net_buffers(gen_params_fast, max(num_images, num_reconstructions, num_interpolations * num_steps))
+    rec_buffers = fast_net_buffers(rec_params_fast, max(num_reconstructions, 2 * num_interpolations))
+
+    # Subtask 3.1: Generate 25 images from prior (use neural_net_predict) and save them using save_images
 
     # Prior sampling
-    z = npr.randn(num_images, latent_dim)
+    z = npr.randn(num_images, latent_dim).astype(np.float32)
 
     # Image generation
-    x = neural_net_predict(gen_params, z)
+    x = neural_net_predict_fast(gen_params_fast, z, gen_buffers)
     images = sigmoid(x)
     save_images(images, "output_images/3_1.png")
 
     # Subtask 3.2: Generate image reconstructions for the first 10 test images (use neural_net_predict for each model) 
     # and save them alongside with the original image using save_images
-    images_to_reconstruct = test_images[:10]
+    images_to_reconstruct = test_images[:num_reconstructions]
 
-    encoder_output = neural_net_predict(rec_params, images_to_reconstruct)
-    z2 = sample_latent_variables_from_posterior(encoder_output)
+    encoder_output = neural_net_predict_fast(rec_params_fast, images_to_reconstruct, rec_buffers)
+    eps = npr.randn(num_reconstructions, latent_dim).astype(np.float32)
+    z2 = sample_latent_variables_from_posterior_fast(encoder_output, eps)
 
-    x2 = neural_net_predict(gen_params, z2)
+    x2 = neural_net_predict_fast(gen_params_fast, z2, gen_buffers)
 
     images_reconstructed = sigmoid(x2)
 
@@ -261,27 +415,25 @@ if __name__ == '__main__':
     # for the third to the fourth and so on until 5 interpolations
     # are computed in latent space and save them using save images.
 
-    num_interpolations = 5
-
-    for i in range(num_interpolations):
-        image1 = test_images[i * 2]
-        image2 = test_images[i * 2 + 1]
+    # Use mean of the recognition model as the latent representation.
+    # The first 2 * num_interpolations test images are encoded with a single call.
+    images_to_interpolate = test_images[:2 * num_interpolations]
+    encoder_output = neural_net_predict_fast(rec_params_fast, images_to_interpolate, rec_buffers)
 
-        # Use mean of the recognition model as the latent representation.
-        encoder_output1 = neural_net_predict(rec_params, image1)
-        encoder_output2 = neural_net_predict(rec_params, image2)
-
-        D1 = np.shape(encoder_output1)[-1] // 2
-        mean1 = encoder_output1[:D1]
+    D = np.shape(encoder_output)[-1] // 2
+    mean1 = encoder_output[0::2, :D]
+    mean2 = encoder_output[1::2, :D]
 
-        D2 = np.shape(encoder_output2)[-1] // 2
-        mean2 = encoder_output2[:D2]
+    # To interpolate from image I to image G use a convex conbination. Namely,
+    # I * s + (1-s) * G where s is a sequence of numbers from 0 to 1 obtained by numpy.linspace.
+    # All the interpolations are stacked in a (num_interpolations * num_steps x latent_dim) matrix
+    # so that they are decoded with a single call.
+    s = np.linspace(0.0, 1.0, num_steps)[None, :, None]
+    interpolations = (mean2[:, None, :] * s + (1 - s) * mean1[:, None, :]).reshape(-1, D).astype(np.float32)
 
-        # To interpolate from image I to image G use a convex conbination. Namely,
-        # I * s + (1-s) * G where s is a sequence of numbers from 0 to 1 obtained by numpy.linspace
-        interpolations = [mean2 * s + (1 - s) * mean1 for s in np.linspace(0.0, 1.0, 25)]
+    interpolated_images = neural_net_predict_fast(gen_params_fast, interpolations, gen_buffers)
 
-        interpolated_images = neural_net_predict(gen_params, interpolations)
+    for i, images in enumerate(np.split(interpolated_images, num_interpolations)):
 
         # Use a different file name to store the images of each iterpolation.
-        save_images(interpolated_images, "output_images/interpolation_{}.png".format(i))
\ No newline at end of file
+        save_images(images, "output_images/interpolation_{}.png".format(i))